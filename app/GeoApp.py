@@ -1,20 +1,79 @@
 import pandas as pd
 import numpy as np
 import spacy
-from geopy import distance
 from geopy.geocoders import Nominatim
+from geopy.adapters import AioHTTPAdapter
+from geopy.extra.rate_limiter import AsyncRateLimiter
 import pgeocode
 import os
+import math
 import ssl
+import atexit
+import shelve
+import asyncio
+from collections import namedtuple
 
 import folium
-from folium.plugins import HeatMap, MarkerCluster
+from folium.plugins import HeatMap, FastMarkerCluster
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QLabel, QLineEdit, QPushButton, QMessageBox
 from PyQt5.QtWidgets import QVBoxLayout, QComboBox, QHBoxLayout
 from PyQt5.QtWebEngineWidgets import QWebEngineView
-from PyQt5.QtCore import QUrl
+from PyQt5.QtCore import QUrl, QThread, pyqtSignal
 from PyQt5.QtGui import QIcon
 
+from sklearn.neighbors import BallTree
+
+from _kernels import EARTH_RADIUS_KM, bounding_box_mask, equirectangular_km, haversine_km, warm_up
+from _postal_codes import match_postal_code
+
+
+# Below this many locations a brute-force scan is faster than querying a BallTree
+BALL_TREE_MIN_LOCATIONS = 5000
+
+# Up to this proximity threshold (in km) the equirectangular approximation is used instead of the haversine
+EQUIRECTANGULAR_MAX_KM = 10
+
+# Pipeline components that do not contribute to doc.ents, excluded when loading the spacy model
+SPACY_UNUSED_PIPES = ['tagger', 'parser', 'lemmatizer', 'attribute_ruler', 'morphologizer', 'senter', 'textcat']
+
+# Maximum content size accepted by QWebEngineView.setHtml
+SET_HTML_MAX_BYTES = 2 * 1024 * 1024
+
+# Leaflet callback building a marker with popup from a [latitude, longitude, address] row of FastMarkerCluster data
+CLUSTER_MARKER_CALLBACK = """
+function (row) {
+    var marker = L.marker(new L.LatLng(row[0], row[1]));
+    marker.bindPopup(row[2], {maxWidth: 250});
+    return marker;
+};
+"""
+
+# Lightweight stand-in for geocoder results served from the geocoding cache
+CachedLocation = namedtuple('CachedLocation', ['latitude', 'longitude'])
+
+
+class ResourceLoader(QThread):
+    '''
+    Background thread loading the geocoders, location data and distance kernels at startup.
+    '''
+    loaded = pyqtSignal()
+    failed = pyqtSignal(str)
+
+    def __init__(self, geo_app):
+        super().__init__(geo_app)
+        self.geo_app = geo_app
+
+    def run(self):
+        try:
+            self.geo_app.load_geocoders()
+            self.geo_app.load_location_data()
+            # Compile the distance kernels so the first query is not penalised by JIT compilation
+            warm_up()
+        except Exception as e:
+            self.failed.emit(str(e))
+            return
+        self.loaded.emit()
+
 
 class GeoApp(QMainWindow):
 
@@ -27,12 +86,26 @@ class GeoApp(QMainWindow):
 
         # TODO: Edit path to database and model accordingly
         self.current_dir = os.path.dirname(os.path.abspath(__file__))
-        self.locations_file = os.path.join(self.current_dir, "data", "locations.pkl")
+        self.locations_file = os.path.join(self.current_dir, "data", "locations.parquet")
+        self.locations_pickle_file = os.path.join(self.current_dir, "data", "locations.pkl")
         self.model_path = os.path.join(self.current_dir, "models", "model-best-sg")
         # self.model_foreign_path = os.path.join(self.current_dir, "models", "model-best-foreign")
         self.location_data = None
+        self.location_tree = None
+        self.location_coords_rad = None
         self.nlp = None
         # self.nlp_foreign = None
+        self.pgeocode_geolocator = None
+        self.geopy_geolocator = None
+        self.ready = False
+        self.load_error = None
+
+        # Set to True to keep a copy of every generated map in the maps folder
+        self.save_maps = False
+
+        # Persistent cache of geocoding results, keyed by geocoding service and postal code
+        self.geo_cache = shelve.open(os.path.join(self.current_dir, "data", "geo_cache.db"))
+        atexit.register(self.geo_cache.close)
 
         # Initialize GUI
         self.setWindowTitle("GeoApp")
@@ -66,6 +139,13 @@ class GeoApp(QMainWindow):
         # Display GUI in full screen
         self.showMaximized()
 
+        # Load backend resources without blocking the GUI
+        self.statusBar().showMessage("Loading, please wait...")
+        self.resource_loader = ResourceLoader(self)
+        self.resource_loader.loaded.connect(self.set_ready)
+        self.resource_loader.failed.connect(self.set_load_failed)
+        self.resource_loader.start()
+
 
     def setup_address_input_layout(self):
         '''
@@ -123,18 +203,80 @@ class GeoApp(QMainWindow):
         self.layout.addLayout(maptype_layout)
 
 
+    def set_ready(self):
+        '''
+        Mark the backend resources as loaded, allowing user input to be processed.
+        '''
+        self.ready = True
+        self.statusBar().clearMessage()
+
+
+    def set_load_failed(self, message):
+        '''
+        Report that the backend resources could not be loaded.
+
+        Args:
+            message (str): The error raised while loading.
+        '''
+        self.load_error = message
+        self.statusBar().showMessage("Loading failed")
+        self.display_error_message(f"Unable to load resources: {message}")
+
+
+    def load_geocoders(self):
+        '''
+        Create the geocoders, once so that their HTTP sessions are kept alive across queries.
+        '''
+        ssl._create_default_https_context = ssl._create_unverified_context # workaround in order to use pgeocode
+        self.pgeocode_geolocator = pgeocode.Nominatim('sg')
+        self.geopy_geolocator = Nominatim(user_agent="myGeocoder")
+
+
     def load_location_data(self):
         """
-        Load the location data from the path.
+        Load the location data from the path, if not already loaded.
+        """
+        if self.location_data is None:
+            columns = ['address', 'postal_code', 'latitude', 'longitude']
+            if os.path.exists(self.locations_file):
+                location_data = pd.read_parquet(self.locations_file, columns=columns)
+            else:
+                # Fall back to the pickle until convert_locations.py has been run
+                location_data = pd.read_pickle(self.locations_pickle_file)[columns]
+            # float32 is precise to well under a metre at Singapore's coordinates, postal codes repeat across addresses
+            self.location_data = location_data.astype(
+                {'latitude': np.float32, 'longitude': np.float32, 'postal_code': 'category'}
+            )
+
+            # Coordinates in radians and cosines of latitudes are reused by every proximity query
+            self.location_coords_rad = self.get_radian_coordinates(self.location_data)
+
+            if len(self.location_data) >= BALL_TREE_MIN_LOCATIONS:
+                lats_rad, lons_rad, _ = self.location_coords_rad
+                self.location_tree = BallTree(np.column_stack([lats_rad, lons_rad]), metric='haversine')
+
+
+    def get_radian_coordinates(self, location_data):
+        """
+        Get the coordinates of the locations in radians, along with the cosines of their latitudes.
+
+        Args:
+            location_data (pandas.DataFrame): The location data.
+
+        Returns:
+            tuple: Arrays of the latitudes, longitudes and cosines of latitudes.
         """
-        self.location_data = pd.read_pickle(self.locations_file)[['address', 'postal_code', 'latitude', 'longitude']]
+        lats_rad = np.radians(location_data['latitude'].to_numpy())
+        lons_rad = np.radians(location_data['longitude'].to_numpy())
+        return lats_rad, lons_rad, np.cos(lats_rad)
 
 
     def load_spacy_model(self):
         '''
-        Load the trained spacy model from the path.
+        Load the trained spacy model from the path, if not already loaded.
         '''
-        self.nlp = spacy.load(self.model_path)
+        if self.nlp is None:
+            self.nlp = spacy.load(self.model_path, exclude=SPACY_UNUSED_PIPES)
         # self.nlp_foreign = spacy.load(self.model_foreign_path)
 
 
@@ -152,6 +294,13 @@ class GeoApp(QMainWindow):
         '''
         Process user input for map type, source address, and proximity threshold.
         '''
+        if not self.ready:
+            if self.load_error is not None:
+                self.display_error_message(f"Unable to load resources: {self.load_error}")
+            else:
+                self.display_error_message("Still loading, please wait.")
+            return
+
         # Take in user input
         input_address = self.input_address.text()
         proximity_threshold = self.input_proximity.text()
@@ -162,7 +311,6 @@ class GeoApp(QMainWindow):
             proximity_threshold = float(proximity_threshold)
 
             self.load_location_data()
-            self.load_spacy_model()
 
             # Current implementation allows for analysis within Singapore only (use of pgeocode requires country input 'sg')
             postal_code = self.extract_postal_code(input_address)
@@ -270,7 +418,7 @@ class GeoApp(QMainWindow):
 
     def extract_postal_code(self, input_address):
         """
-        Extract the postal code from an input address using the loaded nlp model.
+        Extract the postal code from an input address, using the nlp model if no postal code is matched unambiguously.
 
         Args:
             input_address (str): The input address.
@@ -278,7 +426,12 @@ class GeoApp(QMainWindow):
         Returns:
             str: The extracted postal code, or None if not found.
         """
+        postal_code = match_postal_code(input_address)
+        if postal_code is not None:
+            return postal_code
+
         # Process input address using NLP model
+        self.load_spacy_model()
         doc = self.nlp(input_address)
         ent_list = [(ent.text, ent.label_) for ent in doc.ents]
         postal_code = None
@@ -314,22 +467,26 @@ class GeoApp(QMainWindow):
             geopy.location.Location: The location object containing latitude and longitude coordinates, 
             or None if the coordinates could not be retrieved.
         """
-            
+        cache_key = f"{geo_service}:{postal_code}"
+        if cache_key in self.geo_cache:
+            location = CachedLocation(*self.geo_cache[cache_key])
+            print(f"\n[cache___] Postal code: {postal_code}, coordinates: ({location.latitude}, {location.longitude})")
+            return location
+
         # pgeocode method for local
         if geo_service=='pgeocode':
-            ssl._create_default_https_context = ssl._create_unverified_context # workaround in order to use pgeocode    
-            geolocator = pgeocode.Nominatim('sg')
-            location = geolocator.query_postal_code(postal_code)
+            location = self.pgeocode_geolocator.query_postal_code(postal_code)
             if not location.empty:
                 print(f"\n[pgeocode] Postal code: {postal_code}, coordinates: ({location.latitude}, {location.longitude})")
+                self.cache_location(cache_key, location)
                 return location
         
         # geopy method
         # elif geo_service=='geopy':
-        #     geolocator = Nominatim(user_agent="myGeocoder")
-        #     location = geolocator.geocode(postal_code)
+        #     location = self.geopy_geolocator.geocode(postal_code)
         #     if location is not None:
         #         print("[geopy___] Postal code: " + str(postal_code) + ", Result: (" + str(location.latitude) + ", " + str(location.longitude) + ")")
+        #         self.cache_location(cache_key, location)
         #         return location
             
         # can introduce fallback in the future (alternative APIs or geocoding services) to improve geocoding
@@ -338,6 +495,52 @@ class GeoApp(QMainWindow):
             return None
         
 
+    async def bulk_geocode(self, postal_codes):
+        """
+        Convert a batch of postal codes to latitude and longitude coordinates using geopy.
+        Requests are rate limited to respect the Nominatim usage policy, cached postal codes skip the request entirely.
+
+        Args:
+            postal_codes (list): The postal codes to convert.
+
+        Returns:
+            list: The location objects containing latitude and longitude coordinates, in the order of postal_codes,
+            with None for postal codes that could not be geocoded.
+        """
+        locations = {}
+        for postal_code in postal_codes:
+            cache_key = f"geopy:{postal_code}"
+            if cache_key in self.geo_cache:
+                locations[postal_code] = CachedLocation(*self.geo_cache[cache_key])
+
+        uncached_postal_codes = [postal_code for postal_code in dict.fromkeys(postal_codes) if postal_code not in locations]
+        if uncached_postal_codes:
+            async with Nominatim(user_agent="myGeocoder", adapter_factory=AioHTTPAdapter) as geolocator:
+                geocode = AsyncRateLimiter(geolocator.geocode, min_delay_seconds=1)
+                results = await asyncio.gather(*(geocode(postal_code) for postal_code in uncached_postal_codes))
+
+            for postal_code, location in zip(uncached_postal_codes, results):
+                if location is not None:
+                    self.cache_location(f"geopy:{postal_code}", location)
+                locations[postal_code] = location
+
+        return [locations[postal_code] for postal_code in postal_codes]
+
+
+    def cache_location(self, cache_key, location):
+        """
+        Store the coordinates of a geocoded location in the geocoding cache.
+
+        Args:
+            cache_key (str): The key to store the coordinates under.
+            location: The geocoded location with latitude and longitude attributes.
+        """
+        # Do not cache postal codes the geocoder could not resolve
+        if pd.notna(location.latitude) and pd.notna(location.longitude):
+            self.geo_cache[cache_key] = (float(location.latitude), float(location.longitude))
+            self.geo_cache.sync()
+
+
     def create_folium_map(self, df, input_address, latitude, longitude, proximity_threshold, map_type):
         """
         Create a Folium map and add the relevant components.
@@ -354,8 +557,10 @@ class GeoApp(QMainWindow):
             folium.Map: The created Folium map with relevant components.
         """
         custom_zoom = self.get_zoom_level(proximity_threshold)
+        # Draw vector layers on a single canvas instead of creating an SVG node for each of them
         m = folium.Map(location=[latitude, longitude], 
-                       zoom_start=custom_zoom)
+                       zoom_start=custom_zoom,
+                       prefer_canvas=True)
 
         if df is not None:
             if map_type == "Heat Density":
@@ -411,16 +616,13 @@ class GeoApp(QMainWindow):
             m (folium.Map): The Folium map to make additions on.
             df (pandas.DataFrame): The filtered locations DataFrame.
         """
-        # max_cluster_radius is in pixels, consider adjustments to distance
-        marker_cluster = MarkerCluster(max_cluster_radius=150).add_to(m)
+        # Markers are built client-side from a single JSON array instead of rendering a template per marker
+        data = [list(row) for row in zip(df['latitude'].tolist(), df['longitude'].tolist(), df['address'].tolist())]
 
-        for _, row in df.iterrows():
-            lat = row['latitude']
-            lon = row['longitude']
-            popup = folium.Popup(row['address'],
-                                 max_width=250)
-            folium.Marker(location=[lat, lon], 
-                          popup=popup).add_to(marker_cluster)
+        # max_cluster_radius is in pixels, consider adjustments to distance
+        FastMarkerCluster(data,
+                          callback=CLUSTER_MARKER_CALLBACK,
+                          max_cluster_radius=150).add_to(m)
 
 
     def add_markers_to_map(self, m, df, latitude, longitude):
@@ -433,17 +635,21 @@ class GeoApp(QMainWindow):
             latitude (float): The latitude of the user location.
             longitude (float): The longitude of the user location.
         """
-        address_groups = df.groupby(['latitude', 'longitude'])
-        for _, group in address_groups:
-            lat, lng = group['latitude'].iloc[0], group['longitude'].iloc[0]
-            addresses = group['address'].tolist()
+        # Bucket the addresses sharing the same coordinates, one marker per bucket
+        coords, bucket, bucket_sizes = np.unique(df[['latitude', 'longitude']].to_numpy(), axis=0,
+                                                 return_inverse=True, return_counts=True)
+        order = np.argsort(bucket.ravel(), kind='stable')
+        bucket_starts = np.cumsum(bucket_sizes) - bucket_sizes
+        buckets = np.split(df['address'].to_numpy(dtype=object)[order], bucket_starts[1:])
+        # Distance from the input location was already computed in filter_locations
+        distances = df['proximity'].to_numpy()[order[bucket_starts]]
+
+        for (lat, lng), addresses, num_addresses, distance_from_input in zip(coords.tolist(), buckets,
+                                                                             bucket_sizes.tolist(), distances.tolist()):
             popup_content = "<br><br>".join(addresses)
-
-            # Calculate the distance from the input location
-            distance_from_input = distance.distance((latitude, longitude), (lat, lng)).km
             popup_content += f"<br><br>Distance from input: {distance_from_input:.3f} km"
 
-            marker_colour = self.get_marker_colour(len(addresses))
+            marker_colour = self.get_marker_colour(num_addresses)
 
             folium.Marker(
                 location=[lat, lng],
@@ -516,18 +722,16 @@ class GeoApp(QMainWindow):
                 ).add_to(m)
 
 
-    def save_folium_map(self, m, map_filepath):
+    def save_folium_map(self, html, map_filepath):
         """
-        Save the Folium map to a file.
+        Save the rendered Folium map to a file.
 
         Args:
-            address (str): The user input address.
-            m (folium.Map): The Folium map.
+            html (str): The rendered HTML of the Folium map.
             map_filepath (str): The filepath to save the map to.
         """
-        # Generate a unique filename based on the address
-        
-        m.save(map_filepath)
+        with open(map_filepath, 'w', encoding='utf-8') as f:
+            f.write(html)
         print("Map saved to " + map_filepath)
 
 
@@ -545,25 +749,31 @@ class GeoApp(QMainWindow):
         """
         print("Generating map...\n")
 
+        # Generate a unique filename based on the address
         filename = f"map_{input_address.replace(' ', '_')}_{map_type.replace(' ', '_')}.html"
         map_filepath = os.path.join(self.current_dir, "maps", filename)
 
         m = self.create_folium_map(df, input_address, latitude, longitude, proximity_threshold, map_type)
+        html = m.get_root().render()
 
         print("Map generated!\n")
-        
-        self.save_folium_map(m, map_filepath)
-        self.show_map_in_webview(map_filepath)
+
+        # QWebEngineView.setHtml is limited to 2 MB of content, larger maps are loaded from file instead
+        if self.save_maps or len(html.encode('utf-8')) >= SET_HTML_MAX_BYTES:
+            self.save_folium_map(html, map_filepath)
+            self.web_view.load(QUrl.fromLocalFile(map_filepath))
+        else:
+            self.show_map_in_webview(html)
 
 
-    def show_map_in_webview(self, map_filepath):
+    def show_map_in_webview(self, html):
         """
         Show the map in a web view.
 
         Args:
-            map_filepath (str): The filepath of the map file to display.
+            html (str): The rendered HTML of the map to display.
         """
-        self.web_view.load(QUrl.fromLocalFile(map_filepath))
+        self.web_view.setHtml(html, QUrl.fromLocalFile(self.current_dir + os.sep))
 
 
     def get_zoom_level(self, proximity_threshold):
@@ -601,26 +811,34 @@ class GeoApp(QMainWindow):
         Returns:
             pandas.DataFrame: The filtered locations DataFrame.
         """
-        filtered_locations = location_data[
-            location_data.apply(
-                lambda row: distance.distance(
-                    (user_latitude, user_longitude),
-                    (row['latitude'], row['longitude'])
-                ).km <= proximity_threshold,
-                axis=1
-            )
-        ].copy()
-
-        if not filtered_locations.empty:
-            # Sort the filtered locations by proximity
-            filtered_locations['proximity'] = filtered_locations.apply(
-                lambda row: distance.distance(
-                    (user_latitude, user_longitude),
-                    (row['latitude'], row['longitude'])
-                ).km,
-                axis=1
+        if location_data is self.location_data:
+            lats, lons, cos_lats = self.location_coords_rad
+        else:
+            lats, lons, cos_lats = self.get_radian_coordinates(location_data)
+        user_lat_rad, user_lon_rad = math.radians(user_latitude), math.radians(user_longitude)
+
+        if self.location_tree is not None and location_data is self.location_data:
+            # Only compute exact distances for the candidates returned by the tree
+            candidate_idx = self.location_tree.query_radius(
+                [[user_lat_rad, user_lon_rad]], r=proximity_threshold / EARTH_RADIUS_KM
+            )[0]
+        else:
+            # Discard locations outside the bounding box of the proximity circle before computing exact distances
+            candidate_idx = np.flatnonzero(
+                bounding_box_mask(user_lat_rad, user_lon_rad, lats, lons, proximity_threshold)
             )
-            filtered_locations.sort_values(by='proximity', inplace=True)
+
+        distance_km = equirectangular_km if proximity_threshold <= EQUIRECTANGULAR_MAX_KM else haversine_km
+        distances = distance_km(
+            user_lat_rad, user_lon_rad,
+            lats[candidate_idx], lons[candidate_idx], cos_lats[candidate_idx],
+            np.empty(len(candidate_idx), dtype=np.float64)
+        )
+
+        # Reuse the same distances for the proximity column instead of recomputing them
+        mask = distances <= proximity_threshold
+        filtered_locations = location_data.iloc[candidate_idx[mask]].assign(proximity=distances[mask])
+        filtered_locations.sort_values(by='proximity', inplace=True)
 
         return filtered_locations
 
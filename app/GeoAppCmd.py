@@ -3,34 +3,104 @@ User input address and proximity through command line
 Map is opened in a separate window
 '''
 
-import folium
-from folium.plugins import MarkerCluster
 import math
 from geopy.geocoders import Nominatim
-from geopy import distance
+from geopy.extra.rate_limiter import RateLimiter
 import pandas as pd
 import numpy as np
-import spacy
-import webbrowser
 import os
+import sys
+import atexit
+import hashlib
+import shelve
+from collections import namedtuple
 
-from PyQt5.QtWidgets import QApplication
-from PyQt5.QtCore import Qt, QUrl
-from PyQt5.QtWebEngineWidgets import QWebEngineView
+from scipy.spatial import cKDTree
+
+from _kernels import EARTH_RADIUS_KM, bounding_box_extent, bounding_box_mask, haversine_mask, warm_up
+from _postal_codes import match_postal_code
+
+
+GRID_CELL_RAD = math.radians(0.2)  # grid cell size, ~22 km or about 10x a typical proximity threshold
+GRID_COLUMNS = round(2 * math.pi / GRID_CELL_RAD)  # grid cells around a parallel, wrapped at the antimeridian
+KD_TREE_MIN_LOCATIONS = 5000  # below this many locations in a cell a brute-force scan is faster than a kd-tree
+
+SPACY_UNUSED_PIPES = ['tagger', 'parser', 'lemmatizer', 'attribute_ruler', 'morphologizer', 'senter', 'textcat']
+
+FAST_MARKER_CLUSTER_MIN_MARKERS = 1000  # from this many markers they are built client-side by FastMarkerCluster
+# Builds a marker from a [latitude, longitude, popup] row of FastMarkerCluster data
+FAST_MARKER_CALLBACK = """
+function (row) {
+    var icon = L.AwesomeMarkers.icon({icon: 'fa-location-dot', markerColor: 'blue'});
+    var marker = L.marker(new L.LatLng(row[0], row[1]), {icon: icon});
+    marker.bindPopup(row[2], {maxWidth: 250});
+    return marker;
+};
+"""
+
+MAP_CACHE_SIZE = 32  # number of rendered maps kept in the map cache
+TILE_CACHE_MAX_BYTES = 256 * 1024 * 1024  # size of the web view's on-disk HTTP cache holding the map tiles
+
+CachedLocation = namedtuple('CachedLocation', ['latitude', 'longitude'])
 
 
 class GeoAppCmd():
     def __init__(self):
         self.current_dir = os.path.dirname(os.path.abspath(__file__))
-        self.locations_file = os.path.join(self.current_dir, "data", "locations.pkl")
+        self.locations_file = os.path.join(self.current_dir, "data", "locations.parquet")
+        self.locations_pickle_file = os.path.join(self.current_dir, "data", "locations.pkl")
+        self.locations_mtime = None
+        self.map_cache_dir = os.path.join(self.current_dir, "cache")
+        self.tile_cache_dir = os.path.join(self.current_dir, "tile_cache")
         self.model_path = os.path.join(self.current_dir, "..", "address-segmentation", "ner-sg", "output", "models",
                                        "model-best")
         self.location_data = None
+        self.lat = None
+        self.lon = None
+        self.address = None
+        self.lat_rad = None
+        self.lon_rad = None
+        self.cos_lat = None
+        self.grid = {}  # (row, col) grid cell -> indices of the locations in the cell
+        self.grid_rows = range(0)  # rows spanned by the locations, no cell lies outside them
+        self.cell_trees = {}  # (row, col) grid cell -> kd-tree over the locations in the cell
         self.nlp = None
+        self.qt_app = None
+        self.view = None
+
+        self.geolocator = Nominatim(user_agent="myGeocoder", timeout=10)
+        # Nominatim allows at most 1 request per second
+        self.rate_limited_geocode = RateLimiter(self.geolocator.geocode, min_delay_seconds=1.0, max_retries=2)
+        # Geocoding results are memoized in process and persisted across runs, failed lookups are retried
+        self.geocode_cache = shelve.open(os.path.join(self.current_dir, "data", "geocode_cache.db"))
+        atexit.register(self.geocode_cache.close)
+        self.geocode_memo = {}  # address -> CachedLocation
+
+    def geocode(self, address):
+        # The rate limiter returns None once its retries are exhausted, so only found locations are cached
+        if address in self.geocode_memo:
+            return self.geocode_memo[address]
+
+        if address in self.geocode_cache:
+            location = CachedLocation(*self.geocode_cache[address])
+        else:
+            location = self.rate_limited_geocode(address)
+            if location is None:
+                return None
+            location = CachedLocation(location.latitude, location.longitude)
+            self.geocode_cache[address] = tuple(location)
+            self.geocode_cache.sync()
+
+        self.geocode_memo[address] = location
+        return location
 
     def address_to_lat_long(self, address):
-        geolocator = Nominatim(user_agent="myGeocoder")
-        location = geolocator.geocode(address)
+        # A missing postal code must not be geocoded (and cached) as the query "NONE"
+        if address is None:
+            print("\nPostal code not found in the address")
+            return None
+
+        location = self.geocode(" ".join(str(address).split()).upper())
         if location:
             print(f"\n[geocode] Postal code: {address}, coordinates: ({location.latitude}, {location.longitude})")
             return location
@@ -39,18 +109,30 @@ class GeoAppCmd():
             print(f"\nAddress: {address}, Latitude and Longitude not found")
             return None
 
-    def create_folium_map(self, df, input_address, latitude, longitude, proximity_threshold):
+    def create_folium_map(self, lats, lons, addresses, input_address, latitude, longitude, proximity_threshold):
+        import folium
+        from folium.plugins import FastMarkerCluster, MarkerCluster
+
         custom_zoom = self.get_zoom_level(proximity_threshold)
         m = folium.Map(location=[latitude, longitude], zoom_start=custom_zoom)
 
-        address_groups = df.groupby(['latitude', 'longitude'])['address'].apply(list).reset_index()
-        for _, group in address_groups.iterrows():
-            lat, lng = group['latitude'], group['longitude']
-            addresses = group['address']
-            popup_content = "<br>".join(addresses)
-            folium.Marker(location=[lat, lng],
-                        popup=folium.Popup(popup_content, max_width=250),
-                        icon=folium.Icon(icon='fa-location-dot', color='blue')).add_to(m)
+        # Bucket the addresses sharing the same coordinates, one marker per bucket
+        coords, bucket, bucket_sizes = np.unique(np.column_stack([lats, lons]), axis=0,
+                                                 return_inverse=True, return_counts=True)
+        buckets = np.split(addresses[np.argsort(bucket.ravel(), kind='stable')], np.cumsum(bucket_sizes)[:-1])
+        marker_data = [(lat, lng, "<br>".join(bucket_addresses))
+                       for (lat, lng), bucket_addresses in zip(coords.tolist(), buckets)]
+        if len(marker_data) >= FAST_MARKER_CLUSTER_MIN_MARKERS:
+            FastMarkerCluster([list(row) for row in marker_data], callback=FAST_MARKER_CALLBACK).add_to(m)
+        else:
+            markers = [folium.Marker(location=[lat, lng],
+                                     popup=folium.Popup(popup_content, max_width=250),
+                                     icon=folium.Icon(icon='fa-location-dot', color='blue'))
+                       for lat, lng, popup_content in marker_data]
+            marker_cluster = MarkerCluster()
+            for marker in markers:
+                marker_cluster.add_child(marker)
+            marker_cluster.add_to(m)
 
         folium.Marker(location=[latitude, longitude],
                     popup=folium.Popup(input_address, max_width=250),
@@ -71,29 +153,62 @@ class GeoAppCmd():
         m.save(map_filepath)
 
     def display_pyqt_map(self, map_filepath):
-        app = QApplication([])
+        # Qt is imported only when a map is shown, QtWebEngineWidgets has to be imported before QApplication is created
+        from PyQt5.QtWidgets import QApplication
+        from PyQt5.QtCore import Qt, QUrl
+        from PyQt5.QtWebEngineWidgets import QWebEngineView, QWebEngineProfile
+
+        # Qt and the web view are created once and reused for every map
+        if self.view is None:
+            self.qt_app = QApplication.instance() or QApplication([])
+
+            # Map tiles are kept in a persistent disk cache so repeated views around a location skip the network
+            profile = QWebEngineProfile.defaultProfile()
+            profile.setHttpCacheType(QWebEngineProfile.DiskHttpCache)
+            profile.setCachePath(self.tile_cache_dir)
+            profile.setHttpCacheMaximumSize(TILE_CACHE_MAX_BYTES)
 
-        view = QWebEngineView()
-        view.setWindowFlags(Qt.Window | Qt.WindowCloseButtonHint)
-        view.setWindowState(Qt.WindowMaximized)  # Set the window state to maximized
-        view.load(QUrl.fromLocalFile(map_filepath))
-        view.show()
+            self.view = QWebEngineView()
+            self.view.setWindowFlags(Qt.Window | Qt.WindowCloseButtonHint)
+
+        self.view.setWindowState(Qt.WindowMaximized)  # Set the window state to maximized
+        self.view.load(QUrl.fromLocalFile(map_filepath))
+        self.view.show()
 
         # Resize the window to the maximum available size
         desktop = QApplication.desktop()
-        rect = desktop.availableGeometry(view)
-        view.setGeometry(rect)
+        rect = desktop.availableGeometry(self.view)
+        self.view.setGeometry(rect)
 
         print("Map generated!\n")
 
-        app.exec_()
+        self.qt_app.exec_()
+
+    def get_cached_map_filepath(self, input_address, postal_code, proximity_threshold):
+        # The input address is part of the key as it is shown in the popup of the input marker
+        key = repr((postal_code, round(proximity_threshold, 3), input_address)).encode("utf-8")
+        return os.path.join(self.map_cache_dir, f"map_{hashlib.blake2b(key, digest_size=16).hexdigest()}.html")
 
-    def display_map(self, df, input_address, latitude, longitude, proximity_threshold):
+    def evict_cached_maps(self):
+        cached_maps = [os.path.join(self.map_cache_dir, f) for f in os.listdir(self.map_cache_dir)
+                       if f.startswith("map_") and f.endswith(".html")]
+        cached_maps.sort(key=os.path.getmtime, reverse=True)
+        for map_filepath in cached_maps[MAP_CACHE_SIZE:]:
+            os.remove(map_filepath)
+
+    def display_map(self, lats, lons, addresses, input_address, postal_code, latitude, longitude, proximity_threshold):
         print("Generating map...\n")
-        map_filepath = os.path.join(self.current_dir, "map.html")
+        os.makedirs(self.map_cache_dir, exist_ok=True)
+        map_filepath = self.get_cached_map_filepath(input_address, postal_code, proximity_threshold)
+
+        # Reuse the rendered map if it is newer than the location data
+        if os.path.exists(map_filepath) and os.path.getmtime(map_filepath) > self.locations_mtime:
+            os.utime(map_filepath)  # mark as recently used
+        else:
+            m = self.create_folium_map(lats, lons, addresses, input_address, latitude, longitude, proximity_threshold)
+            self.save_folium_map(m, map_filepath)
+            self.evict_cached_maps()
 
-        m = self.create_folium_map(df, input_address, latitude, longitude, proximity_threshold)
-        self.save_folium_map(m, map_filepath)
         self.display_pyqt_map(map_filepath)
 
     def km_to_pixels(self, length_km, latitude, zoom):
@@ -111,8 +226,9 @@ class GeoAppCmd():
         min_zoom = 19  # Minimum zoom level
         max_zoom = 13  # Maximum zoom level
 
-        # Calculate the proportional zoom level
-        zoom_level = np.interp(proximity_threshold, [min_threshold, max_threshold], [min_zoom, max_zoom])
+        # Calculate the proportional zoom level, clamped to the zoom range
+        zoom_level = min_zoom + (max_zoom - min_zoom) * (proximity_threshold - min_threshold) / (max_threshold - min_threshold)
+        zoom_level = max(min(zoom_level, min_zoom), max_zoom)
 
         return int(zoom_level)
 
@@ -125,59 +241,145 @@ class GeoAppCmd():
             except ValueError:
                 print("Invalid input. Please try again.")
 
-    def filter_locations(self, location_data, user_latitude, user_longitude, proximity_threshold):
-        filtered_locations = location_data[
-            location_data.apply(
-                lambda row: distance.distance(
-                    (user_latitude, user_longitude),
-                    (row['latitude'], row['longitude'])
-                ).km <= proximity_threshold,
-                axis=1
-            )
-        ]
-        return filtered_locations
-
-    def print_addresses(self, df, proximity_threshold):
-        addresses = df['address'].tolist()
+    def filter_locations(self, user_latitude, user_longitude, proximity_threshold):
+        # Returns the indices of the locations within the proximity threshold
+        user_lat_rad, user_lon_rad = math.radians(user_latitude), math.radians(user_longitude)
+
+        # Only the grid cells overlapping the bounding box of the proximity circle are searched
+        dlat, dlon = bounding_box_extent(user_lat_rad, proximity_threshold)
+        row_range = range(max(math.floor((user_lat_rad - dlat) / GRID_CELL_RAD), self.grid_rows.start),
+                          min(math.floor((user_lat_rad + dlat) / GRID_CELL_RAD) + 1, self.grid_rows.stop))
+        first_col = math.floor((user_lon_rad - dlon) / GRID_CELL_RAD)
+        last_col = math.floor((user_lon_rad + dlon) / GRID_CELL_RAD)
+        if last_col - first_col + 1 >= GRID_COLUMNS:
+            # The circle spans every longitude, e.g. when it reaches a pole
+            col_range = range(-(GRID_COLUMNS // 2), GRID_COLUMNS - GRID_COLUMNS // 2)
+        else:
+            # Columns past the antimeridian wrap around to the other side of the grid
+            col_range = [self.wrap_grid_column(col) for col in range(first_col, last_col + 1)]
+
+        # Chord length on the unit sphere is monotonic with great-circle distance
+        chord_radius = 2 * math.sin(min(proximity_threshold / (2 * EARTH_RADIUS_KM), math.pi / 2))
+        user_xyz = self.to_unit_xyz(user_lat_rad, user_lon_rad)[0]
+
+        candidates = []
+        for cell in ((row, col) for row in row_range for col in col_range):
+            cell_idx = self.grid.get(cell)
+            if cell_idx is None:
+                continue
+            if cell in self.cell_trees:
+                local_idx = self.cell_trees[cell].query_ball_point(user_xyz, chord_radius)
+                candidates.append(cell_idx[np.asarray(local_idx, dtype=np.intp)])
+            else:
+                # Cheap bounding box comparisons discard most locations before any trigonometry
+                candidates.append(cell_idx[bounding_box_mask(user_lat_rad, user_lon_rad, self.lat_rad[cell_idx],
+                                                             self.lon_rad[cell_idx], proximity_threshold)])
+        idx = np.sort(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.intp)
+
+        within_threshold = haversine_mask(user_lat_rad, user_lon_rad,
+                                          self.lat_rad[idx], self.lon_rad[idx], self.cos_lat[idx],
+                                          proximity_threshold)
+        return idx[within_threshold]
+
+    def print_addresses(self, addresses, proximity_threshold):
         count = len(addresses)
         print(f"Number of locations found within {proximity_threshold} km proximity: {count}\n")
 
         print("-------------------------FILTERED LOCATIONS-------------------------")
-        for address in addresses:
-            print(address)
+        # Write all addresses at once rather than one print call per address
+        sys.stdout.write("".join(f"{address}\n" for address in addresses))
         print("--------------------------------------------------------------------\n")
 
     def load_location_data(self):
-        self.location_data = pd.read_pickle(self.locations_file)[['address', 'postal_code', 'latitude', 'longitude']]
+        columns = ['address', 'postal_code', 'latitude', 'longitude']
+        if os.path.exists(self.locations_file):
+            location_data = pd.read_parquet(self.locations_file, columns=columns)
+            self.locations_mtime = os.path.getmtime(self.locations_file)
+        else:
+            # Fall back to the pickle until convert_locations.py has been run
+            location_data = pd.read_pickle(self.locations_pickle_file)[columns]
+            self.locations_mtime = os.path.getmtime(self.locations_pickle_file)
+        self.location_data = location_data.astype(
+            {'latitude': np.float32, 'longitude': np.float32, 'postal_code': 'category'}
+        )
+
+        # Queries work on contiguous arrays rather than on the DataFrame
+        self.lat = self.location_data['latitude'].to_numpy(dtype=np.float32)
+        self.lon = self.location_data['longitude'].to_numpy(dtype=np.float32)
+        self.address = self.location_data['address'].to_numpy(dtype=object)
+
+        # Radians and cosines of latitudes are constant across queries
+        self.lat_rad = np.radians(self.lat)
+        self.lon_rad = np.radians(self.lon)
+        self.cos_lat = np.cos(self.lat_rad)
+
+        self.build_grid()
+        # Compile the distance kernels before the first query
+        warm_up()
+
+    def build_grid(self):
+        rows = np.floor(self.lat_rad / GRID_CELL_RAD).astype(np.int64)
+        cols = self.wrap_grid_column(np.floor(self.lon_rad / GRID_CELL_RAD).astype(np.int64))
+        self.grid_rows = range(int(rows.min()), int(rows.max()) + 1) if len(rows) else range(0)
+
+        # Sort locations by cell so that every cell is a contiguous run of indices
+        order = np.lexsort((cols, rows))
+        cell_starts = np.flatnonzero(np.diff(rows[order]) | np.diff(cols[order])) + 1
+
+        self.grid = {}
+        self.cell_trees = {}
+        for cell_idx in np.split(order, cell_starts):
+            if len(cell_idx) == 0:
+                continue
+            cell = (int(rows[cell_idx[0]]), int(cols[cell_idx[0]]))
+            self.grid[cell] = cell_idx
+            if len(cell_idx) >= KD_TREE_MIN_LOCATIONS:
+                self.cell_trees[cell] = cKDTree(self.to_unit_xyz(self.lat_rad[cell_idx], self.lon_rad[cell_idx]))
+
+    def wrap_grid_column(self, col):
+        return (col + GRID_COLUMNS // 2) % GRID_COLUMNS - GRID_COLUMNS // 2
+
+    def to_unit_xyz(self, lat_rad, lon_rad):
+        # ECEF coordinates on the unit sphere, where Euclidean distance is a proxy for great-circle distance
+        lat_rad = np.asarray(lat_rad, dtype=np.float64)
+        lon_rad = np.asarray(lon_rad, dtype=np.float64)
+        cos_lat = np.cos(lat_rad)
+        return np.column_stack([cos_lat * np.cos(lon_rad), cos_lat * np.sin(lon_rad), np.sin(lat_rad)])
 
     def load_spacy_model(self):
-        self.nlp = spacy.load(self.model_path)
+        if self.nlp is None:
+            import spacy
+            self.nlp = spacy.load(self.model_path, exclude=SPACY_UNUSED_PIPES)
+
+    def extract_postal_code(self, input_address):
+        # Most addresses contain an unambiguous postal code, the nlp model is only needed otherwise
+        postal_code = match_postal_code(input_address)
+        if postal_code is not None:
+            return postal_code
+
+        self.load_spacy_model()
+        doc = self.nlp(input_address)
+        for ent in doc.ents:
+            if ent.label_ == "POSTAL_CODE":
+                return ent.text
+        return None
 
     def run(self):
         self.load_location_data()
-        self.load_spacy_model()
 
         while True:
             input_address, proximity_threshold = self.get_user_input()
 
-            doc = self.nlp(input_address)
-            ent_list = [(ent.text, ent.label_) for ent in doc.ents]
-            postal_code = None
-            for ent_text, ent_label in ent_list:
-                if ent_label == "POSTAL_CODE":
-                    postal_code = ent_text
-                    break
-
+            postal_code = self.extract_postal_code(input_address)
             user_location = self.address_to_lat_long(postal_code)
             if user_location is not None:
                 user_latitude, user_longitude = user_location.latitude, user_location.longitude
-                filtered_locations = self.filter_locations(self.location_data, user_latitude, user_longitude,
-                                                           proximity_threshold)
+                idx = self.filter_locations(user_latitude, user_longitude, proximity_threshold)
 
-                if not filtered_locations.empty:
-                    self.print_addresses(filtered_locations, proximity_threshold)
-                    self.display_map(filtered_locations, input_address, user_latitude, user_longitude,
-                                     proximity_threshold)
+                if len(idx) > 0:
+                    self.print_addresses(self.address[idx], proximity_threshold)
+                    self.display_map(self.lat[idx], self.lon[idx], self.address[idx], input_address, postal_code,
+                                     user_latitude, user_longitude, proximity_threshold)
                 else:
                     print("No locations found within the specified proximity.")
 
@@ -0,0 +1,155 @@
+'''
+Distance kernels used by GeoApp and GeoAppCmd to filter locations by proximity
+'''
+
+import math
+
+import numpy as np
+from numba import njit, prange
+
+
+EARTH_RADIUS_KM = 6371.0088  # mean Earth radius
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def haversine_km(lat0, lon0, lats, lons, cos_lats, out):
+    """
+    Compute the great-circle distance between a single point and arrays of points.
+    All coordinates are in radians.
+
+    Args:
+        lat0 (float): The latitude of the source point.
+        lon0 (float): The longitude of the source point.
+        lats (numpy.ndarray): The latitudes of the target points.
+        lons (numpy.ndarray): The longitudes of the target points.
+        cos_lats (numpy.ndarray): The precomputed cosines of the target latitudes.
+        out (numpy.ndarray): Preallocated array the distances (in km) are written to.
+
+    Returns:
+        numpy.ndarray: The out array.
+    """
+    cos_lat0 = math.cos(lat0)
+
+    for i in prange(lats.shape[0]):
+        sin_dlat = math.sin((lats[i] - lat0) * 0.5)
+        sin_dlon = math.sin((lons[i] - lon0) * 0.5)
+        a = sin_dlat * sin_dlat + cos_lat0 * cos_lats[i] * sin_dlon * sin_dlon
+        out[i] = 2.0 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+    return out
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def haversine_mask(lat0, lon0, lats, lons, cos_lats, radius_km):
+    """
+    Mask the points lying within a great-circle distance of a single point.
+    All coordinates are in radians.
+
+    Args:
+        lat0 (float): The latitude of the source point.
+        lon0 (float): The longitude of the source point.
+        lats (numpy.ndarray): The latitudes of the target points.
+        lons (numpy.ndarray): The longitudes of the target points.
+        cos_lats (numpy.ndarray): The precomputed cosines of the target latitudes.
+        radius_km (float): The distance in km.
+
+    Returns:
+        numpy.ndarray: Boolean mask of the target points within the distance.
+    """
+    cos_lat0 = math.cos(lat0)
+    # Comparing the haversine term directly avoids the asin and sqrt for every point
+    sin_half_radius = math.sin(min(radius_km / (2.0 * EARTH_RADIUS_KM), math.pi / 2))
+    a_max = sin_half_radius * sin_half_radius
+
+    out = np.empty(lats.shape[0], dtype=np.bool_)
+    for i in prange(lats.shape[0]):
+        sin_dlat = math.sin((lats[i] - lat0) * 0.5)
+        sin_dlon = math.sin((lons[i] - lon0) * 0.5)
+        out[i] = sin_dlat * sin_dlat + cos_lat0 * cos_lats[i] * sin_dlon * sin_dlon <= a_max
+
+    return out
+
+
+@njit(cache=True, parallel=True, fastmath=True)
+def equirectangular_km(lat0, lon0, lats, lons, cos_lats, out):
+    """
+    Compute the equirectangular approximation of the distance between a single point and arrays of points.
+    Cheaper than the haversine and accurate to well under 0.1% for distances of a few km.
+    All coordinates are in radians.
+
+    Args:
+        lat0 (float): The latitude of the source point.
+        lon0 (float): The longitude of the source point.
+        lats (numpy.ndarray): The latitudes of the target points.
+        lons (numpy.ndarray): The longitudes of the target points.
+        cos_lats (numpy.ndarray): The precomputed cosines of the target latitudes.
+        out (numpy.ndarray): Preallocated array the distances (in km) are written to.
+
+    Returns:
+        numpy.ndarray: The out array.
+    """
+    cos_lat0 = math.cos(lat0)
+
+    for i in prange(lats.shape[0]):
+        dy = lats[i] - lat0
+        # cos of the mean latitude, approximated by the mean of the cosines
+        dx = (lons[i] - lon0) * (cos_lat0 + cos_lats[i]) * 0.5
+        out[i] = EARTH_RADIUS_KM * math.sqrt(dx * dx + dy * dy)
+
+    return out
+
+
+def bounding_box_extent(lat0, radius_km):
+    """
+    Get the half-widths of the bounding box of a circle around a source point.
+    The box fully contains the circle. All angles are in radians.
+
+    Args:
+        lat0 (float): The latitude of the source point.
+        radius_km (float): The radius of the circle in km.
+
+    Returns:
+        tuple: The latitude and longitude half-widths, the latter being pi if the circle reaches a pole.
+    """
+    radius = radius_km / EARTH_RADIUS_KM
+
+    sin_dlon = math.sin(radius) / math.cos(lat0)
+    if radius < math.pi / 2 and sin_dlon < 1:
+        return radius, math.asin(sin_dlon)
+    return radius, math.pi
+
+
+def bounding_box_mask(lat0, lon0, lats, lons, radius_km):
+    """
+    Mask the points lying within the bounding box of a circle around a source point.
+    The box fully contains the circle, so it can be used to discard points before computing exact distances.
+    All coordinates are in radians.
+
+    Args:
+        lat0 (float): The latitude of the source point.
+        lon0 (float): The longitude of the source point.
+        lats (numpy.ndarray): The latitudes of the target points.
+        lons (numpy.ndarray): The longitudes of the target points.
+        radius_km (float): The radius of the circle in km.
+
+    Returns:
+        numpy.ndarray: Boolean mask of the target points within the bounding box.
+    """
+    dlat, dlon = bounding_box_extent(lat0, radius_km)
+    mask = np.abs(lats - lat0) <= dlat
+    if dlon < math.pi:
+        # Longitude differences wrap around at the antimeridian
+        lon_diff = np.abs(lons - lon0)
+        mask &= np.minimum(lon_diff, 2 * math.pi - lon_diff) <= dlon
+
+    return mask
+
+
+def warm_up():
+    """
+    Compile the kernels ahead of the first user query.
+    """
+    dummy = np.zeros(2, dtype=np.float32)  # location coordinates are stored as float32
+    haversine_km(0.0, 0.0, dummy, dummy, dummy, np.empty(2, dtype=np.float64))
+    equirectangular_km(0.0, 0.0, dummy, dummy, dummy, np.empty(2, dtype=np.float64))
+    haversine_mask(0.0, 0.0, dummy, dummy, dummy, 1.0)
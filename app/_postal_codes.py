@@ -0,0 +1,35 @@
+'''
+Postal code matching shared by GeoApp and GeoAppCmd, tried before falling back to the nlp model
+'''
+
+import re
+
+
+# Singapore postal codes are 6 digits
+POSTAL_CODE_RE = re.compile(r"\b(\d{6})\b")
+
+# Postal code following "SINGAPORE" or "S", e.g. "SINGAPORE 307591", "S(307591)" or "S307591"
+PREFIXED_POSTAL_CODE_RE = re.compile(r"\b(?:SINGAPORE|S)\s*\(?(\d{6})\b", re.IGNORECASE)
+
+
+def match_postal_code(address):
+    """
+    Match the postal code of an address without the nlp model.
+    Other 6 digit numbers may be part of the address (e.g. a building name), so a postal code is only
+    returned when it is unambiguous.
+
+    Args:
+        address (str): The input address.
+
+    Returns:
+        str: The postal code if there is a single 6 digit number or one following "SINGAPORE"/"S", else None.
+    """
+    matches = POSTAL_CODE_RE.findall(address)
+    if len(matches) == 1:
+        return matches[0]
+
+    prefixed_matches = PREFIXED_POSTAL_CODE_RE.findall(address)
+    if prefixed_matches:
+        return prefixed_matches[-1]
+
+    return None
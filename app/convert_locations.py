@@ -0,0 +1,28 @@
+'''
+One-off migration of data/locations.pkl to a columnar data/locations.parquet
+Only the columns used by the apps are kept, with float32 coordinates and categorical postal codes
+'''
+
+import os
+
+import numpy as np
+import pandas as pd
+
+
+LOCATION_COLUMNS = ['address', 'postal_code', 'latitude', 'longitude']
+
+
+def main():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    pickle_file = os.path.join(current_dir, "data", "locations.pkl")
+    parquet_file = os.path.join(current_dir, "data", "locations.parquet")
+
+    location_data = pd.read_pickle(pickle_file)[LOCATION_COLUMNS]
+    location_data = location_data.astype({'latitude': np.float32, 'longitude': np.float32, 'postal_code': 'category'})
+    location_data.to_parquet(parquet_file, index=False, compression="zstd")
+
+    print(f"Converted {len(location_data)} locations to " + parquet_file)
+
+
+if __name__ == "__main__":
+    main()